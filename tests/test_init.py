@@ -1,89 +1,227 @@
 import asyncio
 import contextlib
-from unittest.mock import MagicMock, patch
+import importlib.util
+import json
+import socket
+import sys
+from unittest.mock import patch
 
 import pytest
-from aiohttp import ClientError, ClientSession, ContentTypeError, TCPConnector
+import pytest_asyncio
+from aiohttp import (
+    ClientError,
+    ClientResponse,
+    ClientSession,
+    ContentTypeError,
+    TCPConnector,
+)
 from aioresponses import aioresponses
 
+import unifi_discovery
 from unifi_discovery import (
     DISCOVERY_PORT,
+    PROTECT_API_ENDPOINT,
+    RECEIVE_BUFFER_SIZE,
     UBNT_REQUEST_PAYLOAD,
+    UBNT_V1_SIGNATURE,
     AIOUnifiScanner,
     UnifiDevice,
     UnifiDiscovery,
     UnifiService,
     async_console_is_alive,
     create_udp_socket,
+    parse_ubnt_response,
 )
 
+_PAYLOAD_GATE = (
+    bytes.fromhex("0100008e")
+    + bytes.fromhex("02000a e063da005e08c0a8d401")
+    + bytes.fromhex("010006 e063da005e08")
+    + bytes.fromhex("0a0004 0013e630")
+    + bytes.fromhex("0b0004")
+    + b"Gate"
+    + bytes.fromhex("0c000a")
+    + b"UVC G4 Pro"
+    + bytes.fromhex("170004 00000000")
+    + bytes.fromhex("030027")
+    + b"UVC.S5L.v4.46.18.67.ceacbaa.211202.1017"
+    + bytes.fromhex("100002 63a5")
+    + bytes.fromhex("200024")
+    + b"32f695ba-835b-5822-bc54-e290e1789ff1"
+)
 
-@pytest.fixture
-def mock_aioresponse():
+_PAYLOAD_UAP = (
+    bytes.fromhex("010000a5")
+    + bytes.fromhex("010006 245a4c75bae6")
+    + bytes.fromhex("02000a 245a4c75bae6c0a8d52f")
+    + bytes.fromhex("030031")
+    + b"UFP-UAP-B.MT7622_SOC.v0.4.0.4.340d302.220106.0349"
+    + bytes.fromhex("040004 c0a8d52f")
+    + bytes.fromhex("050006 245a4c75bae6")
+    + bytes.fromhex("0a0004 000cda2f")
+    + bytes.fromhex("0b0011")
+    + b"AlexanderTechRoom"
+    + bytes.fromhex("0c0009")
+    + b"UFP-UAP-B"
+    + bytes.fromhex("100002 a620")
+    + bytes.fromhex("140018")
+    + b"Unifi-Protect-UAP-Bridge"
+    + bytes.fromhex("170001 00")
+)
+
+# UDM consoles answer with the bare discovery request signature
+_PAYLOAD_UDM = UBNT_REQUEST_PAYLOAD
+
+_EXPECTED_GATE = UnifiDevice(
+    source_ip="192.168.212.1",
+    hw_addr="e0:63:da:00:5e:08",
+    ip_info=["e0:63:da:00:5e:08;192.168.212.1"],
+    addr_entry=None,
+    fw_version="UVC.S5L.v4.46.18.67.ceacbaa.211202.1017",
+    mac_address=None,
+    uptime=1304112,
+    hostname="Gate",
+    platform="UVC G4 Pro",
+    model=None,
+    signature_version="1",
+)
+
+_EXPECTED_UDM_PROTECT_ONLY = UnifiDevice(
+    source_ip="192.168.203.1",
+    hw_addr=None,
+    ip_info=None,
+    addr_entry=None,
+    fw_version=None,
+    mac_address=None,
+    uptime=None,
+    hostname=None,
+    platform=None,
+    model=None,
+    signature_version="1",
+    services={UnifiService.Protect: True},
+    direct_connect_domain=None,
+    is_sso_enabled=None,
+    is_single_user=None,
+)
+
+
+class _FakeTransport:
+    """A minimal stand-in for a datagram transport."""
+
+    __slots__ = ("sent", "closed")
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def sendto(self, data, addr=None):
+        self.sent.append((data, addr))
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """Share one event loop so session scoped async fixtures can be used."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="session")
+async def shared_session():
+    """A ClientSession shared by all tests."""
+    async with ClientSession(connector=TCPConnector(ssl=False, limit=64)) as session:
+        yield session
+
+
+@pytest.fixture(scope="module")
+def uap_device():
+    """The UAP bridge found by the broadcast tests."""
+    return UnifiDevice(
+        source_ip="192.168.213.252",
+        hw_addr="24:5a:4c:75:ba:e6",
+        ip_info=["24:5a:4c:75:ba:e6;192.168.213.47"],
+        addr_entry="192.168.213.47",
+        fw_version="UFP-UAP-B.MT7622_SOC.v0.4.0.4.340d302.220106.0349",
+        mac_address="24:5a:4c:75:ba:e6",
+        uptime=842287,
+        hostname="AlexanderTechRoom",
+        platform="UFP-UAP-B",
+        model="Unifi-Protect-UAP-Bridge",
+        signature_version="1",
+        services={UnifiService.Protect: False},
+        direct_connect_domain=None,
+        is_sso_enabled=None,
+        is_single_user=None,
+    )
+
+
+@pytest.fixture(scope="module")
+def _aiores():
+    """Patch aiohttp once for the whole module."""
     with aioresponses() as m:
         yield m
 
 
+@pytest.fixture
+def mock_aioresponse(_aiores):
+    yield _aiores
+    # reset registered urls and recorded requests between tests
+    _aiores.clear()
+    _aiores.requests.clear()
+
+
 @pytest.fixture
 async def mock_discovery_aio_protocol():
     """Fixture to mock an asyncio connection."""
     loop = asyncio.get_running_loop()
     future = asyncio.Future()
+    ready = asyncio.Event()
 
     async def _wait_for_connection():
-        transport, protocol = await future
-        await asyncio.sleep(0)
-        await asyncio.sleep(0)
-        return transport, protocol
+        await ready.wait()
+        return await future
 
     async def _mock_create_datagram_endpoint(func, sock=None):
         protocol: UnifiDiscovery = func()
-        transport = MagicMock()
+        transport = _FakeTransport()
         protocol.connection_made(transport)
         with contextlib.suppress(asyncio.InvalidStateError):
             future.set_result((transport, protocol))
+        loop.call_soon(ready.set)
         return transport, protocol
 
     with patch.object(loop, "create_datagram_endpoint", _mock_create_datagram_endpoint):
         yield _wait_for_connection
 
 
-@pytest.mark.asyncio
 async def test_async_scanner_specific_address(
     mock_discovery_aio_protocol, mock_aioresponse
 ):
     """Test scanner with a specific address."""
     scanner = AIOUnifiScanner()
-    task = asyncio.ensure_future(
+    task = asyncio.get_running_loop().create_task(
         scanner.async_scan(timeout=10, address="192.168.212.1")
     )
     _, protocol = await mock_discovery_aio_protocol()
     protocol.datagram_received(
-        b"\x01\x00\x00\x8e\x02\x00\n\xe0c\xda\x00^\x08\xc0\xa8\xd4\x01\x01\x00\x06\xe0c\xda\x00^\x08\n\x00\x04\x00\x13\xe60\x0b\x00\x04Gate\x0c\x00\nUVC G4 Pro\x17\x00\x04\x00\x00\x00\x00\x03\x00'UVC.S5L.v4.46.18.67.ceacbaa.211202.1017\x10\x00\x02c\xa5 \x00$32f695ba-835b-5822-bc54-e290e1789ff1",
+        _PAYLOAD_GATE,
         ("192.168.212.1", DISCOVERY_PORT),
     )
     await task
-    assert scanner.found_devices == [
-        UnifiDevice(
-            source_ip="192.168.212.1",
-            hw_addr="e0:63:da:00:5e:08",
-            ip_info=["e0:63:da:00:5e:08;192.168.212.1"],
-            addr_entry=None,
-            fw_version="UVC.S5L.v4.46.18.67.ceacbaa.211202.1017",
-            mac_address=None,
-            uptime=1304112,
-            hostname="Gate",
-            platform="UVC G4 Pro",
-            model=None,
-            signature_version="1",
-        )
-    ]
+    assert scanner.found_devices == [_EXPECTED_GATE]
 
 
-@pytest.mark.asyncio
-async def test_async_scanner_broadcast(mock_discovery_aio_protocol, mock_aioresponse):
+async def test_async_scanner_broadcast(
+    mock_discovery_aio_protocol, mock_aioresponse, shared_session, uap_device
+):
     """Test scanner with a broadcast."""
-    scanner = AIOUnifiScanner()
+    scanner = AIOUnifiScanner(session=shared_session)
     mock_aioresponse.get("https://192.168.203.1/proxy/protect/api", status=401)
     mock_aioresponse.get(
         "https://192.168.203.1/api/system",
@@ -97,25 +235,26 @@ async def test_async_scanner_broadcast(mock_discovery_aio_protocol, mock_aioresp
         },
     )
 
-    task = asyncio.ensure_future(scanner.async_scan(timeout=0.01))
+    task = asyncio.get_running_loop().create_task(scanner.async_scan(timeout=0.01))
     _, protocol = await mock_discovery_aio_protocol()
     protocol.datagram_received(
-        UBNT_REQUEST_PAYLOAD,
+        _PAYLOAD_UDM,
         ("192.168.203.1", DISCOVERY_PORT),
     )
-    protocol.datagram_received(
-        b"",
-        ("127.0.0.1", DISCOVERY_PORT),
-    )
-    protocol.datagram_received(
-        None,
-        ("127.0.0.1", DISCOVERY_PORT),
-    )
-    protocol.datagram_received(
-        b"\x01\x00\x00\xa5\x01\x00\x06$ZLu\xba\xe6\x02\x00\n$ZLu\xba\xe6\xc0\xa8\xd5/\x03\x001UFP-UAP-B.MT7622_SOC.v0.4.0.4.340d302.220106.0349\x04\x00\x04\xc0\xa8\xd5/\x05\x00\x06$ZLu\xba\xe6\n\x00\x04\x00\x0c\xda/\x0b\x00\x11AlexanderTechRoom\x0c\x00\tUFP-UAP-B\x10\x00\x02\xa6 \x14\x00\x18Unifi-Protect-UAP-Bridge\x17\x00\x01\x00",
-        ("192.168.213.252", DISCOVERY_PORT),
+    protocol.datagrams_received_batch(
+        [
+            (b"", ("127.0.0.1", DISCOVERY_PORT)),
+            (None, ("127.0.0.1", DISCOVERY_PORT)),
+            (
+                _PAYLOAD_UAP,
+                ("192.168.213.252", DISCOVERY_PORT),
+            ),
+        ]
     )
     await task
+    # probes must not depend on the session skipping ssl verification
+    for method_url, requests in mock_aioresponse.requests.items():
+        assert all(request.kwargs["ssl"] is False for request in requests), method_url
     assert scanner.found_devices == [
         UnifiDevice(
             source_ip="192.168.203.1",
@@ -134,39 +273,22 @@ async def test_async_scanner_broadcast(mock_discovery_aio_protocol, mock_aioresp
             is_sso_enabled=True,
             is_single_user=True,
         ),
-        UnifiDevice(
-            source_ip="192.168.213.252",
-            hw_addr="24:5a:4c:75:ba:e6",
-            ip_info=["24:5a:4c:75:ba:e6;192.168.213.47"],
-            addr_entry="192.168.213.47",
-            fw_version="UFP-UAP-B.MT7622_SOC.v0.4.0.4.340d302.220106.0349",
-            mac_address="24:5a:4c:75:ba:e6",
-            uptime=842287,
-            hostname="AlexanderTechRoom",
-            platform="UFP-UAP-B",
-            model="Unifi-Protect-UAP-Bridge",
-            signature_version="1",
-            services={UnifiService.Protect: False},
-            direct_connect_domain=None,
-            is_sso_enabled=None,
-            is_single_user=None,
-        ),
+        uap_device,
     ]
 
 
-@pytest.mark.asyncio
 async def test_async_scanner_no_system_response(
-    mock_discovery_aio_protocol, mock_aioresponse
+    mock_discovery_aio_protocol, mock_aioresponse, shared_session, uap_device
 ):
     """Test scanner with a broadcast when the system api does not response."""
-    scanner = AIOUnifiScanner()
+    scanner = AIOUnifiScanner(session=shared_session)
     mock_aioresponse.get("https://192.168.203.1/proxy/protect/api", status=401)
     mock_aioresponse.get("https://192.168.203.1/api/system", status=404)
 
-    task = asyncio.ensure_future(scanner.async_scan(timeout=0.01))
+    task = asyncio.get_running_loop().create_task(scanner.async_scan(timeout=0.01))
     _, protocol = await mock_discovery_aio_protocol()
     protocol.datagram_received(
-        UBNT_REQUEST_PAYLOAD,
+        _PAYLOAD_UDM,
         ("192.168.203.1", DISCOVERY_PORT),
     )
     protocol.datagram_received(
@@ -178,54 +300,21 @@ async def test_async_scanner_no_system_response(
         ("127.0.0.1", DISCOVERY_PORT),
     )
     protocol.datagram_received(
-        b"\x01\x00\x00\xa5\x01\x00\x06$ZLu\xba\xe6\x02\x00\n$ZLu\xba\xe6\xc0\xa8\xd5/\x03\x001UFP-UAP-B.MT7622_SOC.v0.4.0.4.340d302.220106.0349\x04\x00\x04\xc0\xa8\xd5/\x05\x00\x06$ZLu\xba\xe6\n\x00\x04\x00\x0c\xda/\x0b\x00\x11AlexanderTechRoom\x0c\x00\tUFP-UAP-B\x10\x00\x02\xa6 \x14\x00\x18Unifi-Protect-UAP-Bridge\x17\x00\x01\x00",
+        _PAYLOAD_UAP,
         ("192.168.213.252", DISCOVERY_PORT),
     )
     await task
     assert scanner.found_devices == [
-        UnifiDevice(
-            source_ip="192.168.203.1",
-            hw_addr=None,
-            ip_info=None,
-            addr_entry=None,
-            fw_version=None,
-            mac_address=None,
-            uptime=None,
-            hostname=None,
-            platform=None,
-            model=None,
-            signature_version="1",
-            services={UnifiService.Protect: True},
-            direct_connect_domain=None,
-            is_sso_enabled=None,
-            is_single_user=None,
-        ),
-        UnifiDevice(
-            source_ip="192.168.213.252",
-            hw_addr="24:5a:4c:75:ba:e6",
-            ip_info=["24:5a:4c:75:ba:e6;192.168.213.47"],
-            addr_entry="192.168.213.47",
-            fw_version="UFP-UAP-B.MT7622_SOC.v0.4.0.4.340d302.220106.0349",
-            mac_address="24:5a:4c:75:ba:e6",
-            uptime=842287,
-            hostname="AlexanderTechRoom",
-            platform="UFP-UAP-B",
-            model="Unifi-Protect-UAP-Bridge",
-            signature_version="1",
-            services={UnifiService.Protect: False},
-            direct_connect_domain=None,
-            is_sso_enabled=None,
-            is_single_user=None,
-        ),
+        _EXPECTED_UDM_PROTECT_ONLY,
+        uap_device,
     ]
 
 
-@pytest.mark.asyncio
 async def test_async_scanner_system_api_missing_mac(
-    mock_discovery_aio_protocol, mock_aioresponse
+    mock_discovery_aio_protocol, mock_aioresponse, shared_session
 ):
     """Test scanner with a broadcast when the system api responds but no mac."""
-    scanner = AIOUnifiScanner()
+    scanner = AIOUnifiScanner(session=shared_session)
     mock_aioresponse.get("https://192.168.203.1/proxy/protect/api", status=401)
     mock_aioresponse.get(
         "https://192.168.203.1/api/system",
@@ -234,10 +323,10 @@ async def test_async_scanner_system_api_missing_mac(
             "name": "UniFi-CloudKey-Gen2-Plus",
         },
     )
-    task = asyncio.ensure_future(scanner.async_scan(timeout=0.01))
+    task = asyncio.get_running_loop().create_task(scanner.async_scan(timeout=0.01))
     _, protocol = await mock_discovery_aio_protocol()
     protocol.datagram_received(
-        UBNT_REQUEST_PAYLOAD,
+        _PAYLOAD_UDM,
         ("192.168.203.1", DISCOVERY_PORT),
     )
     await task
@@ -262,46 +351,98 @@ async def test_async_scanner_system_api_missing_mac(
     ]
 
 
-@pytest.mark.asyncio
-async def test_async_scanner_system_api_returns_html(
-    mock_discovery_aio_protocol, mock_aioresponse, caplog
+def _import_unifi_discovery_without_orjson():
+    """Import a separate copy of unifi_discovery as if orjson is not installed."""
+    spec = importlib.util.spec_from_file_location(
+        "_unifi_discovery_without_orjson", unifi_discovery.__file__
+    )
+    module = importlib.util.module_from_spec(spec)
+    with patch.dict(sys.modules, {"orjson": None, spec.name: module}):
+        spec.loader.exec_module(module)
+    return module
+
+
+async def test_async_scanner_system_api_without_orjson(
+    mock_discovery_aio_protocol, mock_aioresponse, shared_session
 ):
-    """Test scanner with a broadcast when the system api responds but no mac."""
-    scanner = AIOUnifiScanner()
+    """Test the system api is decoded with the stdlib json when orjson is missing."""
+    module = _import_unifi_discovery_without_orjson()
+    assert module.json_loads is json.loads
+    scanner = module.AIOUnifiScanner(session=shared_session)
     mock_aioresponse.get("https://192.168.203.1/proxy/protect/api", status=401)
     mock_aioresponse.get(
         "https://192.168.203.1/api/system",
-        exception=ContentTypeError,
+        payload={
+            "hardware": {"shortname": "UCKP"},
+            "name": "UniFi-CloudKey-Gen2-Plus",
+        },
     )
-    task = asyncio.ensure_future(scanner.async_scan(timeout=0.01))
+    task = asyncio.get_running_loop().create_task(scanner.async_scan(timeout=0.01))
     _, protocol = await mock_discovery_aio_protocol()
     protocol.datagram_received(
-        UBNT_REQUEST_PAYLOAD,
+        _PAYLOAD_UDM,
         ("192.168.203.1", DISCOVERY_PORT),
     )
     await task
     assert scanner.found_devices == [
-        UnifiDevice(
+        module.UnifiDevice(
             source_ip="192.168.203.1",
-            hw_addr=None,
-            ip_info=None,
-            addr_entry=None,
-            fw_version=None,
-            mac_address=None,
-            uptime=None,
-            hostname=None,
-            platform=None,
-            model=None,
+            hostname="UniFi-CloudKey-Gen2-Plus",
+            platform="UCKP",
             signature_version="1",
-            services={UnifiService.Protect: True},
-            direct_connect_domain=None,
-            is_sso_enabled=None,
-            is_single_user=None,
+            services={module.UnifiService.Protect: True},
         )
     ]
 
 
-@pytest.mark.asyncio
+async def test_async_scanner_shared_connector(
+    mock_discovery_aio_protocol, mock_aioresponse
+):
+    """Test scanner with a connector that is shared between scans."""
+    connector = TCPConnector(ssl=False)
+    scanner = AIOUnifiScanner(connector=connector)
+    mock_aioresponse.get("https://192.168.203.1/proxy/protect/api", status=401)
+    mock_aioresponse.get("https://192.168.203.1/api/system", status=404)
+    with patch.object(
+        ClientResponse, "release", autospec=True, side_effect=ClientResponse.release
+    ) as mock_release:
+        task = asyncio.get_running_loop().create_task(scanner.async_scan(timeout=0.01))
+        _, protocol = await mock_discovery_aio_protocol()
+        protocol.datagram_received(
+            _PAYLOAD_UDM,
+            ("192.168.203.1", DISCOVERY_PORT),
+        )
+        await task
+    assert scanner.found_devices == [_EXPECTED_UDM_PROTECT_ONLY]
+    assert not connector.closed
+    # the protect probe only needs the status so it must not hold the connection
+    assert any(
+        call.args[0].url.path == PROTECT_API_ENDPOINT
+        for call in mock_release.call_args_list
+    )
+    await connector.close()
+
+
+async def test_async_scanner_system_api_returns_html(
+    mock_discovery_aio_protocol, mock_aioresponse, caplog, shared_session
+):
+    """Test scanner with a broadcast when the system api responds but no mac."""
+    scanner = AIOUnifiScanner(session=shared_session)
+    mock_aioresponse.get("https://192.168.203.1/proxy/protect/api", status=401)
+    mock_aioresponse.get(
+        "https://192.168.203.1/api/system",
+        exception=ContentTypeError,
+    )
+    task = asyncio.get_running_loop().create_task(scanner.async_scan(timeout=0.01))
+    _, protocol = await mock_discovery_aio_protocol()
+    protocol.datagram_received(
+        _PAYLOAD_UDM,
+        ("192.168.203.1", DISCOVERY_PORT),
+    )
+    await task
+    assert scanner.found_devices == [_EXPECTED_UDM_PROTECT_ONLY]
+
+
 async def test_async_scanner_falls_back_to_any_source_port_if_socket_in_use():
     """Test port fallback."""
     hold_socket = create_udp_socket(DISCOVERY_PORT)
@@ -310,16 +451,54 @@ async def test_async_scanner_falls_back_to_any_source_port_if_socket_in_use():
     assert random_socket.getsockname() is not None
 
 
-@pytest.mark.asyncio
-async def test_async_console_is_alive(mock_aioresponse):
+def test_parse_ubnt_response_short_payload():
+    """Test empty and truncated payloads are ignored by the parser."""
+    from_address = ("192.168.203.1", DISCOVERY_PORT)
+    assert parse_ubnt_response(None, from_address) is None
+    assert parse_ubnt_response(b"", from_address) is None
+    assert parse_ubnt_response(UBNT_V1_SIGNATURE, from_address) is None
+
+
+def test_create_udp_socket_raises_receive_buffer():
+    """Test the receive buffer is raised for bursts of replies."""
+    options = []
+    original_setsockopt = socket.socket.setsockopt
+
+    def _setsockopt(self, *args):
+        options.append(args)
+        return original_setsockopt(self, *args)
+
+    with patch.object(socket.socket, "setsockopt", _setsockopt):
+        sock = create_udp_socket(DISCOVERY_PORT)
+    sock.close()
+    assert (socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE) in options
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="linux only")
+def test_create_udp_socket_receive_buffer_size_linux():
+    """Test the kernel grants the receive buffer up to net.core.rmem_max."""
+    with open("/proc/sys/net/core/rmem_max") as rmem_max_file:
+        rmem_max = int(rmem_max_file.read())
+    sock = create_udp_socket(DISCOVERY_PORT)
+    try:
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= min(
+            RECEIVE_BUFFER_SIZE, rmem_max
+        )
+    finally:
+        sock.close()
+
+
+async def test_async_console_is_alive(mock_aioresponse, shared_session):
     """Test if a console is alive."""
     mock_aioresponse.get("https://1.2.3.1/api/system", status=401)
     mock_aioresponse.get("https://1.2.3.2/api/system", status=200)
     mock_aioresponse.get("https://1.2.3.3/api/system", exception=ClientError)
     mock_aioresponse.get("https://1.2.3.4/api/system", exception=asyncio.TimeoutError)
 
-    async with ClientSession(connector=TCPConnector(ssl=False)) as session:
-        assert await async_console_is_alive(session, "1.2.3.1") is True
-        assert await async_console_is_alive(session, "1.2.3.2") is True
-        assert await async_console_is_alive(session, "1.2.3.3") is False
-        assert await async_console_is_alive(session, "1.2.3.4") is False
+    results = await asyncio.gather(
+        async_console_is_alive(shared_session, "1.2.3.1"),
+        async_console_is_alive(shared_session, "1.2.3.2"),
+        async_console_is_alive(shared_session, "1.2.3.3"),
+        async_console_is_alive(shared_session, "1.2.3.4"),
+    )
+    assert results == [True, True, False, False]
@@ -4,14 +4,15 @@ import asyncio
 import logging
 import re
 import socket
+import sys
 import time
 from contextlib import suppress
 from dataclasses import dataclass, field, replace
 from enum import Enum, auto
 from http import HTTPStatus
 from ipaddress import ip_address, ip_network
-from struct import unpack
-from typing import TYPE_CHECKING, Awaitable, Callable, cast
+from struct import Struct
+from typing import TYPE_CHECKING, Callable, Final, cast
 
 from aiohttp import (
     ClientError,
@@ -22,6 +23,11 @@ from aiohttp import (
     TCPConnector,
 )
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 if TYPE_CHECKING:
     from pyroute2.iproute import IPRoute  # noqa: F401
 
@@ -48,9 +54,18 @@ IGNORE_NETWORKS = (
 PROBE_PLATFORMS = {"UDMPROSE", "UDMPRO", "UNVR", "UNVRPRO", "UCKP", None}
 
 # UBNT discovery packet payload and reply signature
-UBNT_REQUEST_PAYLOAD = b"\x01\x00\x00\x00"
-UBNT_V1_SIGNATURE = b"\x01\x00\x00"
+UBNT_REQUEST_PAYLOAD: Final = b"\x01\x00\x00\x00"
+UBNT_V1_SIGNATURE: Final = b"\x01\x00\x00"
+# signature plus payload length
+UBNT_HEADER_LEN = 4
+# field type (1 byte) followed by the field length (2 bytes)
+_TLV_HEADER = Struct(">BH")
+_unpack_tlv_header = _TLV_HEADER.unpack_from
+TLV_HEADER_LEN = _TLV_HEADER.size
 DISCOVERY_PORT = 10001
+# Large enough to hold a burst of broadcast replies
+# if the event loop is slow to read them
+RECEIVE_BUFFER_SIZE = 2 * 1024 * 1024
 BROADCAST_FREQUENCY = 3
 ARP_CACHE_POPULATE_TIME = 10
 ARP_TIMEOUT = 10
@@ -59,14 +74,23 @@ IGNORE_MACS = {"00:00:00:00:00:00", "ff:ff:ff:ff:ff:ff"}
 API_TIMEOUT = ClientTimeout(total=5.0)
 SYSTEM_API_ENDPOINT = "/api/system"
 PROTECT_API_ENDPOINT = "/proxy/protect/api"
+# Limit the number of https probes in flight at once
+# since each one may need a full TLS handshake
+MAX_CONCURRENT_PROBES = 16
+# Each console is only sent a protect and a system probe
+PROBE_LIMIT_PER_HOST = 4
 
 # Some MAC addresses will drop the leading zero so
 # our mac validation must allow a single char
 VALID_MAC_ADDRESS = re.compile("^([0-9A-Fa-f]{1,2}[:-]){5}([0-9A-Fa-f]{1,2})$")
 
 
+# Precomputed decimal strings for every byte value
+_OCTETS = tuple(str(i) for i in range(256))
+
+
 def mac_repr(data):
-    return ":".join(("%02x" % b) for b in data)
+    return data.hex(":")
 
 
 def _format_mac(mac: str) -> str:
@@ -74,7 +98,11 @@ def _format_mac(mac: str) -> str:
 
 
 def ip_repr(data):
-    return ".".join(("%d" % b) for b in data)
+    return ".".join([_OCTETS[b] for b in data])
+
+
+def str_repr(data):
+    return str(data, "utf-8")
 
 
 def _fill_neighbor(neighbours, ip, mac):
@@ -102,13 +130,13 @@ FIELD_PARSERS = {
         lambda data: f"{mac_repr(data[0:6])};{ip_repr(data[6:10])}",
         True,
     ),
-    0x03: ("fw_version", bytes.decode, False),
+    0x03: ("fw_version", str_repr, False),
     0x04: ("addr_entry", ip_repr, False),
     0x05: ("mac_address", mac_repr, False),
     0x0A: ("uptime", lambda data: int.from_bytes(data, "big"), False),
-    0x0B: ("hostname", bytes.decode, False),
-    0x0C: ("platform", bytes.decode, False),
-    0x14: ("model", bytes.decode, False),
+    0x0B: ("hostname", str_repr, False),
+    0x0C: ("platform", str_repr, False),
+    0x14: ("model", str_repr, False),
 }
 
 
@@ -117,7 +145,11 @@ def _services_dict():
     return {service: False for service in UnifiService}
 
 
-@dataclass
+# slots are only supported by dataclasses on python 3.10+
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(frozen=True, **_DATACLASS_SLOTS)
 class UnifiDevice:
     """A device discovered."""
 
@@ -152,6 +184,29 @@ async def async_console_is_alive(session: ClientSession, target_ip: str) -> bool
     return True
 
 
+async def _async_limited_get(
+    semaphore: asyncio.Semaphore, session: ClientSession, url: str
+) -> ClientResponse:
+    """Fetch a url while holding the semaphore."""
+    async with semaphore:
+        return await session.get(url, timeout=API_TIMEOUT, ssl=False)
+
+
+async def _async_probe_device(
+    semaphore: asyncio.Semaphore, session: ClientSession, source_ip: str
+) -> list[ClientResponse | Exception]:
+    """Probe the protect and system endpoints of a device concurrently."""
+    return await asyncio.gather(
+        _async_limited_get(
+            semaphore, session, f"https://{source_ip}{PROTECT_API_ENDPOINT}"
+        ),
+        _async_limited_get(
+            semaphore, session, f"https://{source_ip}{SYSTEM_API_ENDPOINT}"
+        ),
+        return_exceptions=True,
+    )
+
+
 def async_get_source_ip(target_ip: str) -> str | None:
     """Return the source ip that will reach target_ip."""
     test_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -170,10 +225,12 @@ def async_get_source_ip(target_ip: str) -> str | None:
 
 
 def iter_fields(data, _len):
+    # data is expected to be a memoryview so the field
+    # slices below are views into the packet, not copies
     pointer = 0
     while pointer < _len:
-        fieldType, fieldLen = unpack(">BH", data[pointer : pointer + 3])
-        pointer += 3
+        fieldType, fieldLen = _unpack_tlv_header(data, pointer)
+        pointer += TLV_HEADER_LEN
         fieldData = data[pointer : pointer + fieldLen]
         pointer += fieldLen
         yield fieldType, fieldData
@@ -182,11 +239,11 @@ def iter_fields(data, _len):
 def parse_ubnt_response(
     payload: bytes | None, from_address: tuple[str, int]
 ) -> UnifiDevice | None:
+    if payload is None or len(payload) < UBNT_HEADER_LEN:
+        return None
+
     # We received a broadcast packet in reply to our discovery
     fields: dict[str, str | list[str]] = {"source_ip": from_address[0]}
-
-    if payload is None or len(payload) < 4:
-        return None
     if (
         payload[0:4] == UBNT_REQUEST_PAYLOAD and from_address[1] != DISCOVERY_PORT
     ):  # Check for a UBNT discovery request
@@ -202,7 +259,7 @@ def parse_ubnt_response(
     # Walk the reply payload, staring from offset 04
     # (just after reply signature and payload size).
     # Take into account the payload length in offset 3
-    for field_type, field_data in iter_fields(payload[4:], payload[3]):
+    for field_type, field_data in iter_fields(memoryview(payload)[4:], payload[3]):
 
         if field_type not in field_parsers_packet_specific:
             continue
@@ -233,6 +290,9 @@ def create_udp_socket(discovery_port: int) -> socket.socket:
     except OSError as err:
         _LOGGER.debug("Port %s is not available: %s", discovery_port, err)
         sock.bind(("", 0))
+    with suppress(OSError):
+        # The kernel may cap or reject this (net.core.rmem_max)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
     sock.setblocking(False)
     return sock
 
@@ -249,8 +309,18 @@ class UnifiDiscovery(asyncio.DatagramProtocol):
 
     def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
         """Trigger on_response."""
+        if not data or len(data) < UBNT_HEADER_LEN:
+            return
         self.on_response(data, addr)
 
+    def datagrams_received_batch(
+        self, batch: list[tuple[bytes, tuple[str, int]]]
+    ) -> None:
+        """Trigger on_response for each datagram in the batch."""
+        datagram_received = self.datagram_received
+        for data, addr in batch:
+            datagram_received(data, addr)
+
     def error_received(self, ex: Exception | None) -> None:
         """Handle error."""
         _LOGGER.error("UnifiDiscovery error: %s", ex)
@@ -345,9 +415,22 @@ class ArpSearch:
 class AIOUnifiScanner:
     """A unifi discovery scanner."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        session: ClientSession | None = None,
+        connector: TCPConnector | None = None,
+    ) -> None:
+        """Init the scanner.
+
+        If a session is passed it will be used to probe devices.
+
+        If a connector is passed instead it will be shared by
+        every scan and is not closed by the scanner.
+        """
         self.found_devices: list[UnifiDevice] = []
         self.source_ip: str | None = None
+        self._session = session
+        self._connector = connector
 
     def _destination_from_address(self, address: str | None) -> tuple[str, int]:
         if address is None:
@@ -429,8 +512,19 @@ class AIOUnifiScanner:
         self, response_list: dict[str, UnifiDevice]
     ) -> None:
         """Check which services are available and update the services dict."""
+        if self._session is not None:
+            await self._probe_services_and_system_with_session(
+                response_list, self._session
+            )
+            return
+        if self._connector is not None:
+            connector = self._connector
+        else:
+            connector = TCPConnector(ssl=False, limit_per_host=PROBE_LIMIT_PER_HOST)
         async with ClientSession(
-            connector=TCPConnector(ssl=False), timeout=API_TIMEOUT
+            connector=connector,
+            connector_owner=self._connector is None,
+            timeout=API_TIMEOUT,
         ) as session:
             await self._probe_services_and_system_with_session(response_list, session)
 
@@ -438,34 +532,34 @@ class AIOUnifiScanner:
         self, response_list: dict[str, UnifiDevice], session: ClientSession
     ) -> None:
         """Check which services are available and update the services dict with a provided session."""
-        device_tasks: dict[str, Awaitable] = {}
-        system_tasks: dict[str, Awaitable] = {}
-        for device in response_list.values():
-            if device.platform in PROBE_PLATFORMS:
-                source_ip = device.source_ip
-                device_tasks[source_ip] = session.get(
-                    f"https://{source_ip}{PROTECT_API_ENDPOINT}"
-                )
-                system_tasks[source_ip] = session.get(
-                    f"https://{source_ip}{SYSTEM_API_ENDPOINT}"
-                )
-        results: list[ClientResponse | Exception] = await asyncio.gather(
-            *(*device_tasks.values(), *system_tasks.values()),
-            return_exceptions=True,
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_PROBES)
+        source_ips = [
+            device.source_ip
+            for device in response_list.values()
+            if device.platform in PROBE_PLATFORMS
+        ]
+        results = await asyncio.gather(
+            *(
+                _async_probe_device(semaphore, session, source_ip)
+                for source_ip in source_ips
+            )
         )
-        device_task_len = len(device_tasks)
-        for idx, source_ip in enumerate(device_tasks):
-            device_response = results[idx]
-            response_list[source_ip].services[UnifiService.Protect] = (
-                device_response.status == HTTPStatus.UNAUTHORIZED
-                if not isinstance(device_response, Exception)
-                else False
+        for source_ip, (device_response, system_response) in zip(source_ips, results):
+            if isinstance(device_response, Exception):
+                has_protect = False
+            else:
+                has_protect = device_response.status == HTTPStatus.UNAUTHORIZED
+                # Only the status is needed, return the connection to the pool
+                device_response.release()
+            device = response_list[source_ip]
+            response_list[source_ip] = replace(
+                device,
+                services={**device.services, UnifiService.Protect: has_protect},
             )
-            system_response = results[idx + device_task_len]
             if isinstance(system_response, Exception):
                 continue
             try:
-                system = await system_response.json()
+                system = await system_response.json(loads=json_loads)
             except ContentTypeError as ex:
                 _LOGGER.debug("System endpoint not available for %s: %s", source_ip, ex)
                 continue